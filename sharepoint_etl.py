@@ -1,16 +1,21 @@
 # sharepoint_etl.py
 
 import os
-import pandas as pd
-from office365.runtime.auth.client_credential import ClientCredential
-from office365.sharepoint.client_context import ClientContext
-from office365.sharepoint.files.file import File
-from office365.sharepoint.listitems.listitem import ListItem
-from office365.sharepoint.lists.list import List
-from office365.sharepoint.folders.folder import Folder
 import io
 import json
+from urllib.parse import quote
+import shutil
+import sqlite3
+import re
 import datetime
+import threading
+import multiprocessing
+from contextlib import closing, redirect_stdout
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+# pandas, numpy, pyarrow and office365 take most of the startup time, so they
+# are imported inside the functions that use them; runs that stop early
+# (e.g. missing credentials) never pay for them
 
 # --- Configuration ---
 SHAREPOINT_SITE_URL = os.environ.get("SHAREPOINT_SITE_URL")
@@ -18,8 +23,32 @@ SHAREPOINT_CLIENT_ID = os.environ.get("SHAREPOINT_CLIENT_ID")
 SHAREPOINT_CLIENT_SECRET = os.environ.get("SHAREPOINT_CLIENT_SECRET")
 SHAREPOINT_DOC_LIBRARY = os.environ.get("SHAREPOINT_DOC_LIBRARY", "Documents") # Default to "Documents" if not set
 SHAREPOINT_FOLDER_PATH = os.environ.get("SHAREPOINT_FOLDER_PATH", "Shared Documents/Your/Target/Folder") # Default path
-MASTER_OUTPUT_FILE = os.environ.get("MASTER_OUTPUT_FILE", "master_lab_results.xlsx") # Default output file name
-PROCESSED_FILES_LOG = os.environ.get("PROCESSED_FILES_LOG", "processed_files.json") # Default log file name
+MASTER_OUTPUT_DIR = os.environ.get("MASTER_OUTPUT_DIR", "master_lab_results") # Default Parquet dataset directory
+LEGACY_MASTER_OUTPUT_FILE = os.environ.get("MASTER_OUTPUT_FILE", "master_lab_results.xlsx") # Pre-Parquet master file, imported once
+MASTER_EXCEL_EXPORT = os.environ.get("MASTER_EXCEL_EXPORT") # Optional Excel copy of the master dataset
+PROCESSED_FILES_LOG = os.environ.get("PROCESSED_FILES_LOG", "processed_files.db") # Default log database (SQLite)
+MAX_DOWNLOAD_WORKERS = int(os.environ.get("MAX_DOWNLOAD_WORKERS", "8")) # Concurrent file downloads
+MAX_PARSE_WORKERS = int(os.environ.get("MAX_PARSE_WORKERS", os.cpu_count() or 1)) # Processes parsing Excel files
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024 # Bytes per chunk when streaming files from SharePoint
+
+# Patterns identifying QC rows (matched case-insensitively in any column)
+# You might need to expand these patterns based on your data
+QC_PATTERNS = ["CCV", "MB", "Blank", "Check"]
+# Compiled once and reused for every column of every file. The pattern is
+# lowercased and matched against lowercased cell values, which is cheaper
+# than having the regex engine fold case on every match attempt
+_QC_RE = re.compile('|'.join(pattern.lower() for pattern in QC_PATTERNS))
+
+# Per-sheet options for the Excel parser, keyed by the sheet names looked for in
+# each workbook. Reading only the needed columns ("usecols") and pinning their
+# types ("dtype") cuts parse time and memory on wide sheets. QC rows are only
+# detected in the columns that are read, so keep any column that can carry QC
+# markers, e.g. "usecols": lambda col: col in {"Sample ID", "Sample Type", "Result"}
+# **UPDATE THIS** to match your workbooks
+SHEET_SCHEMAS = {
+    "Batch Sheet": {"dtype": {"Sample ID": "string"}},
+    "Product Info": {"dtype": {"Sample ID": "string"}},
+}
 
 # --- SharePoint Connection ---
 def connect_to_sharepoint():
@@ -29,6 +58,9 @@ def connect_to_sharepoint():
         print("Please set SHAREPOINT_SITE_URL, SHAREPOINT_CLIENT_ID, and SHAREPOINT_CLIENT_SECRET.")
         return None
 
+    from office365.runtime.auth.client_credential import ClientCredential
+    from office365.sharepoint.client_context import ClientContext
+
     try:
         ctx = ClientContext(SHAREPOINT_SITE_URL).with_credentials(
             ClientCredential(SHAREPOINT_CLIENT_ID, SHAREPOINT_CLIENT_SECRET)
@@ -41,98 +73,244 @@ def connect_to_sharepoint():
         print(f"Error connecting to SharePoint: {e}")
         return None
 
+# ClientContext is not thread-safe, so each download thread gets its own
+_thread_local = threading.local()
+
+def get_thread_sharepoint_context():
+    """Returns a SharePoint context owned by the calling thread, connecting on first use."""
+    ctx = getattr(_thread_local, "ctx", None)
+    if ctx is None:
+        ctx = connect_to_sharepoint()
+        _thread_local.ctx = ctx
+    return ctx
+
 # --- File Discovery ---
+# Items per page when listing files; keeps each request under SharePoint's
+# 5,000-item list view threshold
+LIST_PAGE_SIZE = 2000
+
+# CAML view matching only Excel files, in the queried folder and all its subfolders
+EXCEL_FILES_VIEW_XML = f"""
+<View Scope="RecursiveAll">
+    <Query>
+        <Where>
+            <In>
+                <FieldRef Name="File_x0020_Type"/>
+                <Values>
+                    <Value Type="Text">xlsx</Value>
+                    <Value Type="Text">xls</Value>
+                </Values>
+            </In>
+        </Where>
+    </Query>
+    <RowLimit Paged="TRUE">{LIST_PAGE_SIZE}</RowLimit>
+</View>
+"""
+
+def is_in_skipped_folder(file_dir_ref, folder_url):
+    """Checks whether a file lies below a system folder ("Forms" or "_..."), which are not searched.
+
+    Raises ValueError if file_dir_ref is not folder_url or one of its subfolders.
+    """
+    # SharePoint URLs are case-insensitive; the trailing '/' keeps the prefix
+    # check on a folder boundary (so "/Lab" does not match "/Lab2")
+    folder_prefix = folder_url.rstrip('/').lower() + '/'
+    file_dir = file_dir_ref.rstrip('/') + '/'
+    if not file_dir.lower().startswith(folder_prefix):
+        raise ValueError(f"{file_dir_ref} is not below {folder_url}")
+    relative_path = file_dir[len(folder_prefix):]
+    return any(
+        name.startswith('_') or name == 'Forms'
+        for name in relative_path.split('/') if name
+    )
+
 def list_excel_files_recursive(ctx, folder_path):
-    """Recursively lists all Excel files in a SharePoint folder."""
-    excel_files = []
-    try:
-        root_folder = ctx.web.get_folder_by_server_relative_url(folder_path)
-        ctx.load(root_folder)
-        ctx.load(root_folder.files)
-        ctx.load(root_folder.folders)
-        ctx.execute_query()
+    """Recursively lists all Excel files in a SharePoint folder.
 
-        # Add Excel files in the current folder
-        for file in root_folder.files:
-            if file.name.lower().endswith(('.xlsx', '.xls')):
-                excel_files.append(file.server_relative_url)
+    Returns a list of (server_relative_url, time_last_modified) tuples, or None
+    if the folder could not be listed. The extension filter and the recursion
+    both run on the server; results are fetched in pages of LIST_PAGE_SIZE.
+    Files below system folders ("Forms" or names starting with "_") are skipped.
+    """
+    import pandas as pd
+    from office365.sharepoint.listitems.caml.query import CamlQuery
 
-        # Recursively process subfolders
-        for folder in root_folder.folders:
-            # Skip system folders like "Forms"
-            if not folder.name.startswith('_') and folder.name != 'Forms':
-                 excel_files.extend(list_excel_files_recursive(ctx, folder.server_relative_url))
+    try:
+        # Resolve the folder's exact server-relative URL, then the document
+        # library that contains it
+        folder = ctx.web.get_folder_by_server_relative_url(folder_path)
+        ctx.load(folder, ["ServerRelativeUrl"])
+        ctx.execute_query()
+        folder_url = folder.server_relative_url
+        doc_library = ctx.web.get_list(folder_url)
+
+        query = CamlQuery()
+        query.ViewXml = EXCEL_FILES_VIEW_XML
+        query.FolderServerRelativeUrl = folder_url
+        items = doc_library.get_items(query, page_size=LIST_PAGE_SIZE).expand(["File"]).select(
+            ["Id", "FileDirRef", "File/ServerRelativeUrl", "File/TimeLastModified"]
+        )
+        ctx.execute_query()
 
+        # Iterating fetches any remaining pages
+        excel_files = []
+        for item in items:
+            try:
+                if is_in_skipped_folder(item.properties.get("FileDirRef", ""), folder_url):
+                    continue
+            except ValueError as e:
+                print(f"Warning: Skipping {item.file.server_relative_url}: {e}")
+                continue
+            excel_files.append(item.file)
     except Exception as e:
         print(f"Error listing files in {folder_path}: {e}")
+        return None
+
+    if not excel_files:
+        return []
 
-    return excel_files
+    # TimeLastModified is returned as a string like '2023-10-27T10:00:00Z'
+    # Parse all of them to UTC timestamps in one vectorized call. Missing or
+    # malformed values become NaT rather than failing the whole listing (the
+    # client reports a missing value as datetime.min)
+    last_modified_times = pd.to_datetime(
+        [None if file.time_last_modified == datetime.datetime.min else file.time_last_modified
+         for file in excel_files],
+        utc=True, format='ISO8601', errors='coerce',
+    )
+
+    files_with_times = []
+    for file, last_modified_time in zip(excel_files, last_modified_times):
+        if pd.isna(last_modified_time):
+            print(f"Could not get modified time for {file.server_relative_url}. Skipping for now.")
+            continue
+        files_with_times.append((file.server_relative_url, last_modified_time))
+
+    return files_with_times
 
 # --- Data Extraction and Processing ---
 def read_excel_from_sharepoint(ctx, file_url):
     """Reads an Excel file from SharePoint into a pandas DataFrame."""
+    from office365.runtime.http.request_options import RequestOptions
+
     try:
-        file = File.open_binary(ctx, file_url)
-        ctx.execute_query()
-        file_content = io.BytesIO(file.content)
+        # Stream the file down in chunks rather than as one buffered response
+        file_content = io.BytesIO()
+        # Issue the streamed GET directly (as File.open_binary does): File.download_session
+        # first loads the file's metadata, costing an extra round trip per file
+        escaped_url = quote(file_url.replace("'", "''"))
+        request = RequestOptions(
+            f"{ctx.service_root_url}/web/getFileByServerRelativePath(DecodedUrl='{escaped_url}')/$value"
+        )
+        request.stream = True
+        response = ctx.pending_request().execute_request_direct(request)
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            file_content.write(chunk)
+        file_content.seek(0)
         return file_content
     except Exception as e:
         print(f"Error reading file {file_url}: {e}")
         return None
 
+def download_excel_file(file_url):
+    """Downloads a SharePoint file using the calling thread's own context."""
+    ctx = get_thread_sharepoint_context()
+    if not ctx:
+        return None
+    return read_excel_from_sharepoint(ctx, file_url)
+
+def open_excel_workbook(file_content):
+    """Opens an Excel workbook, preferring the Rust-based calamine reader."""
+    import pandas as pd
+
+    try:
+        # calamine reads both .xlsx and legacy .xls files
+        return pd.ExcelFile(file_content, engine='calamine')
+    except ImportError:
+        # python-calamine is not installed, fall back to pandas' default engine
+        # (openpyxl for .xlsx, xlrd for .xls)
+        file_content.seek(0)
+        return pd.ExcelFile(file_content)
+
 def process_excel_file(file_content):
     """Processes a single Excel file, extracting data from specified sheets."""
-    all_sheet_data = pd.DataFrame()
-    sheets_to_process = ["Batch Sheet", "Product Info"] # Sheets to look for
+    import pandas as pd
+
+    sheet_frames = []
+    sheets_to_process = list(SHEET_SCHEMAS) # Sheets to look for
 
     try:
-        xls = pd.ExcelFile(file_content)
-        available_sheets = xls.sheet_names
-
-        for sheet_name in sheets_to_process:
-            # Simple check for sheet name variations (can be expanded)
-            actual_sheet_name = None
-            for available_sheet in available_sheets:
-                if sheet_name.lower() in available_sheet.lower():
-                    actual_sheet_name = available_sheet
-                    break
-
-            if actual_sheet_name:
+        # Opening the workbook only reads its sheet list, not any cell data
+        with open_excel_workbook(file_content) as xls:
+            # Lowercase the available sheet names once (Excel sheet names are
+            # unique ignoring case, so the lowercase names make unique keys)
+            available_sheets = {sheet.lower(): sheet for sheet in xls.sheet_names}
+
+            matched_sheets = []
+            for sheet_name in sheets_to_process:
+                # Simple check for sheet name variations (can be expanded)
+                target = sheet_name.lower()
+                actual_sheet_name = available_sheets.get(target)
+                if actual_sheet_name is None:
+                    actual_sheet_name = next(
+                        (sheet for lowered, sheet in available_sheets.items() if target in lowered), None
+                    )
+
+                if actual_sheet_name:
+                    matched_sheets.append((sheet_name, actual_sheet_name))
+                else:
+                    print(f"  Warning: Sheet '{sheet_name}' not found in the file.")
+
+            # Skip the file before parsing any cells if no target sheet exists
+            if not matched_sheets:
+                print("  No target sheets found in the file. Skipping.")
+                return pd.DataFrame()
+
+            for sheet_name, actual_sheet_name in matched_sheets:
                 print(f"  Processing sheet: {actual_sheet_name}")
                 try:
-                    # Read the sheet, assuming the first row is headers
-                    df = xls.parse(actual_sheet_name)
-                    # Add a column to indicate the source sheet
-                    df['_SourceSheet'] = actual_sheet_name
-                    all_sheet_data = pd.concat([all_sheet_data, df], ignore_index=True)
+                    # Read the sheet, assuming the first row is headers, and add
+                    # a column to indicate the source sheet
+                    df = xls.parse(actual_sheet_name, **SHEET_SCHEMAS.get(sheet_name, {})).assign(
+                        _SourceSheet=actual_sheet_name
+                    )
+                    sheet_frames.append(df)
                 except Exception as e:
                     print(f"    Error reading sheet {actual_sheet_name}: {e}")
-            else:
-                print(f"  Warning: Sheet '{sheet_name}' not found in the file.")
 
     except Exception as e:
         print(f"Error processing Excel content: {e}")
 
-    return all_sheet_data
+    # Concatenate once at the end rather than growing a DataFrame per sheet
+    return pd.concat(sheet_frames, ignore_index=True) if sheet_frames else pd.DataFrame()
 
 # --- Data Cleaning and Filtering ---
 def clean_and_filter_data(df):
     """Cleans and filters the consolidated data."""
+    import numpy as np
+    import pandas as pd
+
     initial_rows = len(df)
     print(f"Initial rows before cleaning: {initial_rows}")
 
+    # Each step below only narrows a boolean row mask; the rows are sliced
+    # out once at the end so no intermediate DataFrames are materialized
+
     # 1. Skip blank rows (check if all values in a row are NaN or None)
-    df.dropna(how='all', inplace=True)
-    print(f"Rows after dropping blank rows: {len(df)}")
-
-    # 2. Skip rows identified as QC rows (example patterns)
-    # You might need to expand these patterns based on your data
-    qc_patterns = ["CCV", "MB", "Blank", "Check"]
-    # Create a regex pattern that matches any of the QC patterns in any column
-    qc_regex = '|'.join(qc_patterns)
-    # Check if any column in a row contains a QC pattern (case-insensitive)
-    df = df[~df.astype(str).apply(lambda row: row.str.contains(qc_regex, case=False, na=False)).any(axis=1)]
-    print(f"Rows after dropping QC rows: {len(df)}")
+    keep = ~df.isna().all(axis=1).to_numpy()
+    print(f"Rows after dropping blank rows: {keep.sum()}")
+
+    # 2. Skip rows identified as QC rows (see QC_PATTERNS)
+    # Check if any column in a row contains a QC pattern (case-insensitive).
+    # Scan column by column so each check is a single vectorized string op
+    qc_mask = np.zeros(len(df), dtype=bool)
+    for col in df.columns:
+        values = df[col]
+        if values.dtype != object:
+            values = values.astype(str)
+        qc_mask |= values.str.lower().str.contains(_QC_RE, na=False, regex=True).to_numpy()
+    keep &= ~qc_mask
+    print(f"Rows after dropping QC rows: {keep.sum()}")
 
     # 3. Skip partial entries (define key columns that must be present)
     # Replace 'KeyColumn1', 'KeyColumn2' with actual column names that must be non-null
@@ -140,50 +318,183 @@ def clean_and_filter_data(df):
     # Ensure key columns exist before checking
     key_columns_exist = [col for col in key_columns if col in df.columns]
     if key_columns_exist:
-        df.dropna(subset=key_columns_exist, inplace=True)
-        print(f"Rows after dropping partial entries (based on {key_columns_exist}): {len(df)}")
+        keep &= df[key_columns_exist].notna().all(axis=1).to_numpy()
+        print(f"Rows after dropping partial entries (based on {key_columns_exist}): {keep.sum()}")
     else:
         print(f"Warning: Key columns for partial entry check not found: {key_columns}")
 
+    df = df.iloc[keep]
 
     # Add more cleaning steps as needed (e.g., data type conversion, removing extra whitespace)
-    # Example: Strip whitespace from string columns
-    for col in df.select_dtypes(include='object').columns:
-        df[col] = df[col].str.strip()
+    # Example: Strip whitespace from string columns, assigning them all in one go
+    # (columns pinned to the "string" dtype in SHEET_SCHEMAS are included)
+    text_columns = df.select_dtypes(include=['object', 'string']).columns
+    if len(text_columns):
+        df[text_columns] = pd.DataFrame({col: df[col].str.strip() for col in text_columns}, index=df.index)
 
     print(f"Final rows after cleaning: {len(df)}")
     return df
 
+def parse_and_clean_excel_file(file_url, file_bytes):
+    """Parses and cleans the raw bytes of a downloaded Excel file in a worker process.
+
+    Returns a (cleaned DataFrame or None if no data could be extracted, output)
+    tuple. The progress output is captured and returned, labelled with
+    file_url, so output from parallel workers does not interleave.
+    """
+    output = io.StringIO()
+    with redirect_stdout(output):
+        print(f"Parsing {file_url}")
+        file_data = process_excel_file(io.BytesIO(file_bytes))
+        cleaned_data = clean_and_filter_data(file_data) if not file_data.empty else None
+    return cleaned_data, output.getvalue()
+
 # --- Daily Update Logic ---
-def load_processed_files_log(log_file):
-    """Loads the log of processed files and their timestamps."""
-    if os.path.exists(log_file):
-        with open(log_file, 'r') as f:
-            try:
-                return json.load(f)
-            except json.JSONDecodeError:
-                print(f"Warning: Could not decode JSON from {log_file}. Starting with empty log.")
-                return {}
-    return {}
+SQLITE_FILE_HEADER = b"SQLite format 3\x00"
+
+def _convert_json_processed_files_log(log_file):
+    """Converts a processed files log in the old JSON format to SQLite, in place.
+
+    The original JSON file is kept alongside as <log_file>.bak.
+    """
+    with open(log_file, 'r') as f:
+        processed_files = json.load(f)
+    if not isinstance(processed_files, dict):
+        raise ValueError("expected a JSON object mapping file URLs to modified times")
+
+    backup_file = f"{log_file}.bak"
+    temp_file = f"{log_file}.tmp"
+    shutil.copy2(log_file, backup_file)
+    if os.path.exists(temp_file):
+        os.remove(temp_file)
+    save_processed_files_log(temp_file, processed_files)
+    # Swap the converted log in atomically
+    os.replace(temp_file, log_file)
+    print(f"Converted JSON processed files log {log_file} to SQLite ({len(processed_files)} entries). "
+          f"Original kept as {backup_file}.")
 
-def save_processed_files_log(log_file, processed_files):
-    """Saves the log of processed files and their timestamps."""
-    with open(log_file, 'w') as f:
-        json.dump(processed_files, f, indent=4)
+def load_processed_files_log(log_file):
+    """Loads the log of processed files and their timestamps.
 
-def get_sharepoint_file_modified_time(ctx, file_url):
-    """Gets the last modified time of a SharePoint file."""
+    Returns None if the log exists but cannot be read.
+    """
     try:
-        file = ctx.web.get_file_by_server_relative_url(file_url)
-        ctx.load(file, ["TimeLastModified"])
-        ctx.execute_query()
-        # TimeLastModified is returned as a string like '2023-10-27T10:00:00Z'
-        # Convert to datetime object
-        return datetime.datetime.fromisoformat(file.time_last_modified.replace('Z', '+00:00'))
-    except Exception as e:
-        print(f"Error getting modified time for {file_url}: {e}")
+        if os.path.exists(log_file) and os.path.getsize(log_file) > 0:
+            with open(log_file, 'rb') as f:
+                is_sqlite = f.read(len(SQLITE_FILE_HEADER)) == SQLITE_FILE_HEADER
+            if not is_sqlite:
+                # Logs written by earlier versions of this script are JSON
+                _convert_json_processed_files_log(log_file)
+
+        with closing(sqlite3.connect(log_file)) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS processed (url TEXT PRIMARY KEY, mtime TEXT)")
+            return dict(conn.execute("SELECT url, mtime FROM processed"))
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print(f"Error: Could not read processed files log {log_file}: {e}")
         return None
 
+def save_processed_files_log(log_file, processed_files):
+    """Records processed files and their timestamps, touching only the given entries."""
+    with closing(sqlite3.connect(log_file)) as conn:
+        # A single transaction, so the log is never left half-written
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS processed (url TEXT PRIMARY KEY, mtime TEXT)")
+            conn.executemany(
+                "INSERT OR REPLACE INTO processed (url, mtime) VALUES (?, ?)",
+                processed_files.items(),
+            )
+
+# --- Master Output ---
+def append_to_master_dataset(master_dir, df):
+    """Writes new rows to the master dataset as a new Parquet file under today's partition."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    run_time = datetime.datetime.now()
+    partition_dir = os.path.join(master_dir, f"date={run_time:%Y-%m-%d}")
+    os.makedirs(partition_dir, exist_ok=True)
+    part_file = os.path.join(partition_dir, f"part-{run_time:%H%M%S%f}.parquet")
+
+    # Parquet needs string column names and a single type per column. Columns
+    # keep their own types; only Excel columns mixing e.g. numbers and text
+    # (which Arrow cannot store as one type) are stored as text
+    df = df.rename(columns=str)
+    arrays = []
+    for col in range(df.shape[1]):
+        values = df.iloc[:, col]
+        try:
+            arrays.append(pa.array(values, from_pandas=True))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            arrays.append(pa.array(values.astype('string'), type=pa.string(), from_pandas=True))
+    table = pa.Table.from_arrays(arrays, names=list(df.columns))
+
+    pq.write_table(table, part_file)
+    return part_file
+
+def read_master_dataset(master_dir):
+    """Reads the full master Parquet dataset into a DataFrame.
+
+    Part files written by different runs may have different columns and
+    column types. Missing columns are filled with nulls and compatible types
+    are promoted (e.g. int64 to double); a column whose types conflict across
+    part files (e.g. double in one run, text in another) is read back as text.
+    The date=YYYY-MM-DD directories only organise the files and are not
+    returned as a column.
+    """
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(master_dir, format="parquet")
+    tables = [fragment.to_table() for fragment in dataset.get_fragments()]
+    if not tables:
+        return pd.DataFrame()
+
+    column_names = {name for table in tables for name in table.column_names}
+    conflicting_columns = set()
+    for name in column_names:
+        fields = [table.schema.field(name) for table in tables if name in table.column_names]
+        try:
+            pa.unify_schemas([pa.schema([field]) for field in fields], promote_options="permissive")
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            conflicting_columns.add(name)
+
+    for i, table in enumerate(tables):
+        for name in conflicting_columns & set(table.column_names):
+            index = table.column_names.index(name)
+            table = table.set_column(index, name, table.column(index).cast(pa.string()))
+        tables[i] = table
+
+    return pa.concat_tables(tables, promote_options="permissive").to_pandas()
+
+def master_dataset_has_parts(master_dir):
+    """Checks whether the master dataset contains any Parquet part files."""
+    return any(
+        name.endswith('.parquet')
+        for _, _, file_names in os.walk(master_dir) for name in file_names
+    )
+
+def import_legacy_master_file(master_dir, legacy_file):
+    """Imports the pre-Parquet master Excel file as the first part of an empty master dataset.
+
+    Files already recorded in the processed files log are not read again, so
+    their rows only reach the dataset through this import. Returns the number
+    of rows imported (0 if there was nothing to import).
+    """
+    import pandas as pd
+
+    if not os.path.exists(legacy_file) or master_dataset_has_parts(master_dir):
+        return 0
+    legacy_data = pd.read_excel(legacy_file)
+    append_to_master_dataset(master_dir, legacy_data)
+    return len(legacy_data)
+
+def export_master_to_excel(master_dir, excel_file):
+    """Exports the full master Parquet dataset to an Excel file."""
+    master_data = read_master_dataset(master_dir)
+    master_data.to_excel(excel_file, index=False)
+    return len(master_data)
+
 # --- Main ETL Process ---
 def run_etl():
     """Runs the main ETL process."""
@@ -191,78 +502,131 @@ def run_etl():
     if not ctx:
         return
 
+    import pandas as pd
+
     print(f"Searching for Excel files in: {SHAREPOINT_DOC_LIBRARY}/{SHAREPOINT_FOLDER_PATH}")
     # Construct the full server relative path
     full_sharepoint_path = f"/{SHAREPOINT_DOC_LIBRARY}/{SHAREPOINT_FOLDER_PATH}"
     all_excel_files = list_excel_files_recursive(ctx, full_sharepoint_path)
+    if all_excel_files is None:
+        print("Aborting: the Excel files in the SharePoint folder could not be listed.")
+        return
     print(f"Found {len(all_excel_files)} potential Excel files.")
 
     processed_files_log = load_processed_files_log(PROCESSED_FILES_LOG)
-    data_to_append = pd.DataFrame()
-    updated_processed_files_log = processed_files_log.copy()
-
-    for file_url in all_excel_files:
-        last_modified_time = get_sharepoint_file_modified_time(ctx, file_url)
-
-        if last_modified_time:
-            # Convert datetime to string for comparison and storage
-            last_modified_str = last_modified_time.isoformat()
+    if processed_files_log is None:
+        # Without the log every file would be reprocessed and appended again
+        print("Aborting so that no data is appended to the master dataset twice.")
+        return
 
-            if file_url in processed_files_log:
-                # File was processed before, check if modified
-                if processed_files_log[file_url] == last_modified_str:
-                    print(f"Skipping {file_url}: Not modified since last run.")
+    try:
+        imported_rows = import_legacy_master_file(MASTER_OUTPUT_DIR, LEGACY_MASTER_OUTPUT_FILE)
+        if imported_rows:
+            print(f"Imported {imported_rows} rows from {LEGACY_MASTER_OUTPUT_FILE} into {MASTER_OUTPUT_DIR}")
+    except Exception as e:
+        # The logged files would otherwise be skipped and their rows lost
+        print(f"Error importing {LEGACY_MASTER_OUTPUT_FILE} into {MASTER_OUTPUT_DIR}: {e}")
+        print("Aborting so that previously processed data is not lost.")
+        return
+    cleaned_frames = []
+    # Only new or changed entries are written back to the log
+    updated_processed_files_log = {}
+
+    # Work out which files need processing before downloading anything: a
+    # file is skipped when its modified time matches the one logged for it
+    files_to_process = [
+        (file_url, last_modified_time.isoformat())
+        for file_url, last_modified_time in all_excel_files
+        if processed_files_log.get(file_url) != last_modified_time.isoformat()
+    ]
+    print(f"Skipping {len(all_excel_files) - len(files_to_process)} files not modified since last run.")
+    for file_url, _ in files_to_process:
+        if file_url in processed_files_log:
+            print(f"Processing {file_url}: Modified since last run.")
+        else:
+            print(f"Processing {file_url}: New file.")
+
+    # Downloads are I/O-bound and independent, so fetch them concurrently.
+    # Parsing and cleaning is CPU-bound, so each downloaded file is handed to
+    # a worker process as soon as its content arrives. Spawned (not forked)
+    # workers avoid forking a process that is running download threads
+    with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as download_executor, \
+            ProcessPoolExecutor(max_workers=MAX_PARSE_WORKERS,
+                                mp_context=multiprocessing.get_context("spawn")) as parse_executor:
+        download_futures = {
+            download_executor.submit(download_excel_file, file_url): (file_url, last_modified_str)
+            for file_url, last_modified_str in files_to_process
+        }
+        parse_futures = {}
+        for future in as_completed(download_futures):
+            file_url, last_modified_str = download_futures[future]
+            file_content = future.result()
+            if file_content:
+                print(f"Downloaded {file_url}")
+                try:
+                    parse_future = parse_executor.submit(parse_and_clean_excel_file, file_url, file_content.getvalue())
+                except Exception as e:
+                    # e.g. the pool broke after a worker was killed
+                    print(f"  Could not start parsing {file_url}: {e!r}. Skipping processing.")
                     continue
-                else:
-                    print(f"Processing {file_url}: Modified since last run.")
+                parse_futures[parse_future] = (file_url, last_modified_str)
             else:
-                print(f"Processing {file_url}: New file.")
+                 print(f"  Could not read content for {file_url}. Skipping processing.")
 
-            # Process the file
-            file_content = read_excel_from_sharepoint(ctx, file_url)
-            if file_content:
-                file_data = process_excel_file(file_content)
-                if not file_data.empty:
-                    cleaned_data = clean_and_filter_data(file_data)
-                    data_to_append = pd.concat([data_to_append, cleaned_data], ignore_index=True)
-                    # Update the log with the new modified time
-                    updated_processed_files_log[file_url] = last_modified_str
-                else:
-                    print(f"  No data extracted from {file_url}.")
+        for future in as_completed(parse_futures):
+            file_url, last_modified_str = parse_futures[future]
+            try:
+                cleaned_data, output = future.result()
+            except Exception as e:
+                # A failed file (or a crashed worker) must not discard the others
+                print(f"Error parsing {file_url}: {e!r}. Skipping processing.")
+                continue
+            print(output, end="")
+            if cleaned_data is not None:
+                cleaned_frames.append(cleaned_data)
+                # Update the log with the new modified time
+                updated_processed_files_log[file_url] = last_modified_str
             else:
-                 print(f"  Could not read content for {file_url}. Skipping processing.")
-        else:
-            print(f"Could not get modified time for {file_url}. Skipping for now.")
+                print(f"  No data extracted from {file_url}.")
 
+    data_to_append = pd.concat(cleaned_frames, ignore_index=True) if cleaned_frames else pd.DataFrame()
 
     if not data_to_append.empty:
-        print(f"\nAppending {len(data_to_append)} new/modified rows to {MASTER_OUTPUT_FILE}")
+        print(f"\nAppending {len(data_to_append)} new/modified rows to {MASTER_OUTPUT_DIR}")
         try:
-            # Check if master file exists to decide between writing and appending
-            if os.path.exists(MASTER_OUTPUT_FILE):
-                # Read existing data and append
-                existing_data = pd.read_excel(MASTER_OUTPUT_FILE)
-                consolidated_data = pd.concat([existing_data, data_to_append], ignore_index=True)
-            else:
-                # No existing file, this is the first run or file was deleted
-                consolidated_data = data_to_append
-
-            # Write the consolidated data to the master file
-            consolidated_data.to_excel(MASTER_OUTPUT_FILE, index=False)
-            print(f"Successfully updated {MASTER_OUTPUT_FILE} with {len(data_to_append)} new/modified rows.")
+            # Only the new rows are written; existing data is never re-read
+            part_file = append_to_master_dataset(MASTER_OUTPUT_DIR, data_to_append)
+            print(f"Successfully wrote {len(data_to_append)} new/modified rows to {part_file}.")
+        except Exception as e:
+            print(f"Error writing to master dataset {MASTER_OUTPUT_DIR}: {e}")
+            return
 
+        try:
             # Save the updated processed files log
             save_processed_files_log(PROCESSED_FILES_LOG, updated_processed_files_log)
             print(f"Updated processed files log: {PROCESSED_FILES_LOG}")
-
         except Exception as e:
-            print(f"Error writing to master Excel file {MASTER_OUTPUT_FILE}: {e}")
+            print(f"Error saving processed files log {PROCESSED_FILES_LOG}: {e}")
+            print(f"Remove {part_file} before the next run, or its rows will be appended again.")
+            return
+
+        if MASTER_EXCEL_EXPORT and os.path.abspath(MASTER_EXCEL_EXPORT) == os.path.abspath(LEGACY_MASTER_OUTPUT_FILE):
+            print(f"Not exporting to {MASTER_EXCEL_EXPORT}: it is the legacy master file (MASTER_OUTPUT_FILE). "
+                  f"Choose a different MASTER_EXCEL_EXPORT path.")
+        elif MASTER_EXCEL_EXPORT:
+            try:
+                total_rows = export_master_to_excel(MASTER_OUTPUT_DIR, MASTER_EXCEL_EXPORT)
+                print(f"Exported {total_rows} rows to {MASTER_EXCEL_EXPORT}")
+            except Exception as e:
+                print(f"Error exporting master dataset to {MASTER_EXCEL_EXPORT}: {e}")
     else:
         print("\nNo new or modified data to append.")
         # If no new data, still save the log to record files that were checked
-        save_processed_files_log(PROCESSED_FILES_LOG, updated_processed_files_log)
-        print(f"Updated processed files log: {PROCESSED_FILES_LOG}")
-
+        try:
+            save_processed_files_log(PROCESSED_FILES_LOG, updated_processed_files_log)
+            print(f"Updated processed files log: {PROCESSED_FILES_LOG}")
+        except Exception as e:
+            print(f"Error saving processed files log {PROCESSED_FILES_LOG}: {e}")
 
 if __name__ == "__main__":
     run_etl()
\ No newline at end of file